@@ -1,16 +1,26 @@
 import os
-import requests
+import heapq
+import json
+import orjson
 import sys
-from flask import Flask, request, jsonify
+import threading
+import tiktoken
+import time
+from cachetools import LRUCache, TTLCache, cached
+from operator import itemgetter
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
+from chroma_store import open_vectorstore, CHROMA_DIR
+from langchain_qdrant import QdrantVectorStore
+from embedding_model import get_embeddings, compile_embeddings, QueryCachedEmbeddings, EMBED_MODEL_NAME
+from qdrant_store import get_qdrant_client, QDRANT_COLLECTION
+from nvd_client import create_nvd_session, NVD_API_URL
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
-from datetime import datetime, timedelta 
+from langchain_core.runnables import RunnableGenerator, RunnableParallel, RunnablePassthrough
+from datetime import datetime, timedelta, timezone
 
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -29,40 +39,52 @@ if not os.getenv('OPENAI_API_KEY'):
 print(f"Environment loaded from: {os.path.abspath(env_path)}")
 load_dotenv('.env')
 
+# Conversation history sent to the LLM is capped at this many tokens
+HISTORY_TOKEN_BUDGET = 1500
+history_encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+
+# Shared keep-alive session for NVD API calls
+nvd_session = create_nvd_session()
+
 app = Flask(__name__)
 CORS(app)  # Enable CORS for React frontend
 
 vectorstore = None
 qa_chain = None
 retriever = None
+llm = None
+
+# /api/stats is polled by dashboards; the collection count is refreshed at
+# most once per STATS_CACHE_TTL seconds
+STATS_CACHE_TTL = 60
+stats_cache = {'count': None, 'timestamp': 0}
+
+# Answers keyed by the rendered prompt (question, history and retrieved
+# CVEs), so a repeated question skips the OpenAI call. Bounded like the
+# retrieval caches, since keys are whole prompts
+answer_cache = LRUCache(maxsize=2048)
+answer_cache_lock = threading.Lock()
 
 def initialize_system():
     """Initialize the RAG system (called once at startup)"""
-    global vectorstore, qa_chain, retriever
+    global vectorstore, qa_chain, retriever, llm
     
     print("="*60)
     print("Initializing CyberRAG System...")
     print("="*60)
     
     # Load embeddings
-    print("Loading HuggingFace embeddings...")
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-mpnet-base-v2",
-        model_kwargs={'device': 'mps'},
-        encode_kwargs={'normalize_embeddings': True}
-    )
+    print("Loading embeddings...")
+    embeddings = QueryCachedEmbeddings(compile_embeddings(get_embeddings()))
     
     # Load vector store
     print("Loading vector store...")
-    vectorstore = Chroma(
-        persist_directory="./chroma_db_all",
-        embedding_function=embeddings,
-        collection_name="cve_all_collection"
-    )
+    vectorstore = open_vectorstore(embeddings)
     
     # Get collection count
     collection = vectorstore._collection
     count = collection.count()
+    stats_cache.update(count=count, timestamp=time.time())
     print(f"Vector store loaded: {count:,} CVEs")
     
     # Initialize LLM
@@ -72,21 +94,36 @@ def initialize_system():
         temperature=0.7
     )
     
+    # Use the INT8-quantized Qdrant copy for similarity search if configured
+    # (see migrate_to_qdrant.py); ChromaDB still serves stats and ID lookups
+    search_store = vectorstore
+    qdrant_client = get_qdrant_client()
+    if qdrant_client:
+        print("Using quantized Qdrant collection for retrieval...")
+        search_store = QdrantVectorStore(
+            client=qdrant_client,
+            collection_name=QDRANT_COLLECTION,
+            embedding=embeddings
+        )
+    
     # Create retriever
-    retriever = vectorstore.as_retriever(
+    retriever = search_store.as_retriever(
         search_kwargs={"k": 5}  # Return top 5 relevant CVEs
     )
     
-    # Creating QA chain
+    # Creating QA chain: retrieval runs once and feeds both the prompt
+    # and the returned sources
     template = """You are a cybersecurity expert assistant specializing in vulnerability analysis.
 
-Answer the user's question based on the following CVE vulnerability information from the National Vulnerability Database:
+Previous conversation:
+{history}
 
-Context: {context}
+Current context from CVE database:
+{context}
 
-Question: {question}
+Current question: {question}
 
-Provide a clear, accurate, and helpful answer. If the information isn't in the context, say so. Be concise but informative.
+Provide a clear, accurate, and helpful answer. Consider the conversation history when answering. If referring to something from earlier in the conversation, acknowledge it naturally. If the information isn't in the context, say so.
 
 Answer:"""
     
@@ -95,16 +132,120 @@ Answer:"""
     def format_docs(docs):
         return "\n\n".join(doc.page_content for doc in docs)
     
-    qa_chain = (
-        {"context": retriever | format_docs, "question": RunnablePassthrough()}
+    llm_answer = llm | StrOutputParser()
+    
+    # LangChain's global LLM cache is only consulted by invoke, not stream,
+    # so the streamed /api/query path checks answer_cache here instead: a
+    # hit is replayed as one chunk, a miss is streamed and then stored
+    def cached_answer(prompt_values):
+        for prompt_value in prompt_values:
+            key = prompt_value.to_string()
+            with answer_cache_lock:
+                answer = answer_cache.get(key)
+            if answer is not None:
+                yield answer
+                continue
+            
+            parts = []
+            for delta in llm_answer.stream(prompt_value):
+                parts.append(delta)
+                yield delta
+            answer = "".join(parts)
+            if answer:
+                with answer_cache_lock:
+                    answer_cache[key] = answer
+    
+    answer_chain = (
+        RunnablePassthrough.assign(context=lambda x: format_docs(x["docs"]))
         | prompt
-        | llm
-        | StrOutputParser()
+        | RunnableGenerator(cached_answer)
+    )
+    
+    qa_chain = (
+        RunnablePassthrough.assign(docs=lambda x: retrieve(x["question"]))
+        | RunnableParallel(answer=answer_chain, sources=itemgetter("docs"))
     )
     
     print("✓ CyberRAG system initialized successfully!")
     print("="*60 + "\n")
 
+# Results for repeated queries and CVE lookups are reused for an hour, so
+# changes from the nightly update show up without restarting the server
+@cached(TTLCache(maxsize=2048, ttl=3600), lock=threading.Lock())
+def cached_retrieve(normalized_query):
+    return tuple(retriever.invoke(normalized_query))
+
+def retrieve(query_text):
+    """Retrieve relevant CVEs, keyed by the stripped query text
+
+    Case is kept: whether the embedding model is case-sensitive depends on
+    CVE_EMBED_MODEL.
+    """
+    return list(cached_retrieve(query_text.strip()))
+
+# Only hits are cached, so a CVE added by the nightly update is found on
+# the next request instead of returning 404 until the entry expires
+lookup_cache = TTLCache(maxsize=2048, ttl=3600)
+lookup_cache_lock = threading.Lock()
+
+def lookup_cve(cve_id):
+    """Fetch a stored CVE record by its ID"""
+    
+    with lookup_cache_lock:
+        results = lookup_cache.get(cve_id)
+    if results is not None:
+        return results
+    
+    collection = vectorstore._collection
+    
+    # CVE IDs are the vector IDs, so this is a primary-key lookup
+    results = collection.get(ids=[cve_id], include=['metadatas', 'documents'])
+    if not results['ids']:
+        # Entries embedded before CVE IDs were used as vector IDs
+        results = collection.get(
+            where={"cve_id": cve_id},
+            include=['metadatas', 'documents']
+        )
+    
+    if results['ids']:
+        with lookup_cache_lock:
+            lookup_cache[cve_id] = results
+    return results
+
+def build_history_context(conversation_history):
+    """Format recent conversation turns for the prompt, within a token budget"""
+    
+    # Take last 3 exchanges (6 messages), then drop the oldest turns until
+    # the history fits in HISTORY_TOKEN_BUDGET tokens
+    turns = [
+        f"{msg.get('role', 'user').capitalize()}: {msg.get('content', '')}\n\n"
+        for msg in conversation_history[-6:]
+    ]
+    token_counts = [len(history_encoding.encode(turn)) for turn in turns]
+    
+    while turns and sum(token_counts) > HISTORY_TOKEN_BUDGET:
+        turns.pop(0)
+        token_counts.pop(0)
+    
+    return "".join(turns)
+
+def format_sources(docs):
+    """Format retrieved documents as source entries for the API response"""
+    
+    return [{
+        "cve_id": doc.metadata.get('cve_id'),
+        "severity": doc.metadata.get('cvss_severity'),
+        "score": doc.metadata.get('cvss_score', 'N/A'),
+        "status": doc.metadata.get('vulnStatus'),
+        "published": doc.metadata.get('published', '')[:10],
+        "year": doc.metadata.get('year'),
+        "description_preview": doc.page_content[:150] + "..."
+    } for doc in docs]
+
+def sse_event(payload):
+    """Format a payload as a Server-Sent Events message"""
+    return f"data: {json.dumps(payload)}\n\n"
+
 # ============================================================================
 # API ENDPOINTS
 # ============================================================================
@@ -115,7 +256,7 @@ def health_check():
     return jsonify({
         "status": "healthy",
         "message": "CyberRAG API is running",
-        "timestamp": str(os.popen('date').read().strip())
+        "timestamp": datetime.now(timezone.utc).isoformat()
     }), 200
 
 @app.route('/api/query', methods=['POST'])
@@ -137,51 +278,40 @@ def query():
             print(f"With {len(conversation_history)} previous messages")
         
         # Build context from conversation history
-        history_context = ""
-        if conversation_history:
-            # Take last 3 exchanges (6 messages) to avoid token limits
-            recent_history = conversation_history[-6:]
-            for msg in recent_history:
-                role = msg.get('role', 'user')
-                content = msg.get('content', '')
-                history_context += f"{role.capitalize()}: {content}\n\n"
-        
-        # Get source documents
-        source_docs = retriever.invoke(user_query)
-        
-        # Format sources
-        sources = []
-        context_text = ""
-        for doc in source_docs:
-            context_text += doc.page_content + "\n\n"
-            sources.append({
-                "cve_id": doc.metadata.get('cve_id'),
-                "severity": doc.metadata.get('cvss_severity'),
-                "score": doc.metadata.get('cvss_score'),
-                "status": doc.metadata.get('vulnStatus'),
-                "published": doc.metadata.get('published', '')[:10],
-                "year": doc.metadata.get('year'),
-                "description_preview": doc.page_content[:150] + "..."
-            })
-        
-        # Create prompt with history
-        prompt_with_history = f"""You are a cybersecurity expert assistant specializing in vulnerability analysis.
-
-Previous conversation:
-{history_context}
-
-Current context from CVE database:
-{context_text}
-
-Current question: {user_query}
-
-Provide a clear, accurate, and helpful answer. Consider the conversation history when answering. If referring to something from earlier in the conversation, acknowledge it naturally. If the information isn't in the context, say so.
-
-Answer:"""
+        history_context = build_history_context(conversation_history)
+        
+        chain_input = {"question": user_query, "history": history_context}
+        
+        # Stream the answer as Server-Sent Events unless ?stream=0 is passed
+        if request.args.get('stream', '1') != '0':
+            def generate():
+                try:
+                    for chunk in qa_chain.stream(chain_input):
+                        if "sources" in chunk:
+                            sources = format_sources(chunk["sources"])
+                            yield sse_event({
+                                "type": "sources",
+                                "query": user_query,
+                                "sources": sources,
+                                "source_count": len(sources)
+                            })
+                        if chunk.get("answer"):
+                            yield sse_event({"type": "delta", "delta": chunk["answer"]})
+                    yield sse_event({"type": "done"})
+                    print(f"✓ Query streamed successfully")
+                except Exception as e:
+                    print(f"✗ Error streaming answer: {e}")
+                    yield sse_event({"type": "error", "error": str(e)})
+            
+            return Response(
+                stream_with_context(generate()),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
         
-        # Get answer from LLM
-        llm = ChatOpenAI(model="gpt-3.5-turbo", temperature=0.7)
-        answer = llm.invoke(prompt_with_history).content
+        result = qa_chain.invoke(chain_input)
+        answer = result["answer"]
+        sources = format_sources(result["sources"])
         
         print(f"✓ Query processed successfully")
         
@@ -205,8 +335,9 @@ Answer:"""
 def stats():
     """Get database statistics"""
     try:
-        collection = vectorstore._collection
-        count = collection.count()
+        if time.time() - stats_cache['timestamp'] >= STATS_CACHE_TTL:
+            stats_cache.update(count=vectorstore._collection.count(), timestamp=time.time())
+        count = stats_cache['count']
         
         # Get last update time
         last_update = "Unknown"
@@ -217,8 +348,8 @@ def stats():
         return jsonify({
             "success": True,
             "total_cves": count,
-            "database": "chroma_db_all",
-            "embedding_model": "sentence-transformers/all-mpnet-base-v2",
+            "database": os.path.basename(CHROMA_DIR),
+            "embedding_model": EMBED_MODEL_NAME,
             "last_update": last_update
         }), 200
         
@@ -243,14 +374,14 @@ def search():
             }), 400
         
         # Use retriever to find relevant CVEs
-        docs = retriever.invoke(search_query)
+        docs = retrieve(search_query)
         
         results = []
         for doc in docs[:limit]:
             results.append({
                 "cve_id": doc.metadata.get('cve_id'),
                 "severity": doc.metadata.get('cvss_severity'),
-                "score": doc.metadata.get('cvss_score'),
+                "score": doc.metadata.get('cvss_score', 'N/A'),
                 "status": doc.metadata.get('vulnStatus'),
                 "published": doc.metadata.get('published', '')[:10],
                 "description": doc.page_content
@@ -274,13 +405,8 @@ def search():
 def get_cve(cve_id):
     """Get details for a specific CVE by ID"""
     try:
-        collection = vectorstore._collection
-        
         # Search for CVE by ID
-        results = collection.get(
-            where={"cve_id": cve_id.upper()},
-            include=['metadatas', 'documents']
-        )
+        results = lookup_cve(cve_id.upper())
         
         if not results or not results['ids']:
             return jsonify({
@@ -297,7 +423,7 @@ def get_cve(cve_id):
             "success": True,
             "cve_id": metadata.get('cve_id'),
             "severity": metadata.get('cvss_severity'),
-            "score": metadata.get('cvss_score'),
+            "score": metadata.get('cvss_score', 'N/A'),
             "status": metadata.get('vulnStatus'),
             "published": metadata.get('published', '')[:10],
             "lastModified": metadata.get('lastModified', '')[:10],
@@ -351,19 +477,17 @@ def get_news():
         print(f"Fetching CVEs from {start_str} to {end_str}")
         
         # Fetch from NVD API
-        nvd_api_key = os.getenv('NVD_API_KEY')
-        headers = {}
-        if nvd_api_key:
-            headers['apiKey'] = nvd_api_key
-        
-        url = "https://services.nvd.nist.gov/rest/json/cves/2.0"
         params = {
             "lastModStartDate": start_str,
             "lastModEndDate": end_str,
             "resultsPerPage": min(limit, 2000)
         }
         
-        response = requests.get(url, params=params, headers=headers)
+        # Let NVD filter by severity so only matching CVEs are transferred
+        if severity:
+            params["cvssV3Severity"] = severity
+        
+        response = nvd_session.get(NVD_API_URL, params=params, timeout=30)
         
         if response.status_code != 200:
             return jsonify({
@@ -371,11 +495,11 @@ def get_news():
                 "error": f"NVD API error: {response.status_code}"
             }), 500
         
-        nvd_data = response.json()
+        nvd_data = orjson.loads(response.content)
         vulnerabilities = nvd_data.get('vulnerabilities', [])
         
-        # Process and filter CVEs
-        cves = []
+        # First pass: only the fields needed to filter and rank each CVE
+        candidates = []
         for vuln in vulnerabilities:
             cve = vuln['cve']
             
@@ -392,10 +516,19 @@ def get_news():
                 cvss_score = metrics['cvssMetricV2'][0]['cvssData'].get('baseScore', 'N/A')
                 cvss_severity = metrics['cvssMetricV2'][0].get('baseSeverity', 'N/A')
             
-            # Filter by severity if specified
+            # NVD matches any CVSS v3.x severity; drop the rare CVE whose
+            # displayed (v3.1/v2) severity differs from the requested one
             if severity and cvss_severity != severity:
                 continue
             
+            candidates.append((cve['lastModified'], cvss_score, cvss_severity, cve))
+        
+        # Newest first; only the top `limit` are needed, so avoid a full sort
+        newest = heapq.nlargest(limit, candidates, key=itemgetter(0))
+        
+        # Second pass: build response objects only for the CVEs returned
+        cves = []
+        for last_modified, cvss_score, cvss_severity, cve in newest:
             # Extract description
             description = ""
             for desc in cve.get('descriptions', []):
@@ -403,26 +536,21 @@ def get_news():
                     description = desc['value']
                     break
             
-            cve_obj = {
+            cves.append({
                 "cve_id": cve['id'],
                 "severity": cvss_severity,
                 "score": str(cvss_score),
                 "status": cve.get('vulnStatus', 'Unknown'),
                 "published": cve['published'][:10],
-                "lastModified": cve['lastModified'][:10],
+                "lastModified": last_modified[:10],
                 "description": description,
                 "year": cve['published'][:4]
-            }
-            
-            cves.append(cve_obj)
-        
-        # Sort by lastModified (newest first)
-        cves.sort(key=lambda x: x['lastModified'], reverse=True)
+            })
         
         return jsonify({
             "success": True,
-            "cves": cves[:limit],
-            "total": len(cves),
+            "cves": cves,
+            "total": len(candidates),
             "filter": filter_type,
             "date_range": {
                 "start": start_str,
@@ -478,6 +606,7 @@ if __name__ == '__main__':
     print("\n" + "="*60)
     print("Server running on http://localhost:5001")
     print("Press Ctrl+C to stop")
+    print("For production use: gunicorn -c gunicorn.conf.py api:app")
     print("="*60 + "\n")
     
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5001, debug=os.getenv('FLASK_DEBUG') == '1', threaded=True)
\ No newline at end of file
@@ -0,0 +1,51 @@
+import time
+import chromadb
+from chroma_store import CHROMA_DIR, CHROMA_COLLECTION, HNSW_METADATA
+
+def build_index(batch_size=1000):
+    """Rebuild the CVE collection with the tuned HNSW parameters
+
+    Chroma fixes HNSW parameters when a collection is created, so the stored
+    embeddings are copied into a new collection (no re-embedding), which then
+    replaces the old one.
+    """
+    
+    client = chromadb.PersistentClient(path=CHROMA_DIR)
+    old_collection = client.get_collection(CHROMA_COLLECTION)
+    total = old_collection.count()
+    
+    rebuild_name = f"{CHROMA_COLLECTION}_rebuild"
+    if rebuild_name in [c.name for c in client.list_collections()]:
+        client.delete_collection(rebuild_name)
+    new_collection = client.create_collection(rebuild_name, metadata=HNSW_METADATA)
+    
+    print(f"Rebuilding HNSW index for {total:,} CVEs")
+    print(f"  Parameters: {HNSW_METADATA}")
+    
+    copied = 0
+    for offset in range(0, total, batch_size):
+        batch = old_collection.get(
+            limit=batch_size,
+            offset=offset,
+            include=['embeddings', 'documents', 'metadatas']
+        )
+        new_collection.add(
+            ids=batch['ids'],
+            embeddings=batch['embeddings'],
+            documents=batch['documents'],
+            metadatas=batch['metadatas']
+        )
+        copied += len(batch['ids'])
+        print(f"  Copied {copied:,}/{total:,} CVEs...")
+    
+    # Swap the rebuilt collection in under the original name
+    client.delete_collection(CHROMA_COLLECTION)
+    new_collection.modify(name=CHROMA_COLLECTION)
+    
+    print(f"✓ Index rebuilt: {copied:,} CVEs")
+
+if __name__ == "__main__":
+    start_time = time.time()
+    build_index()
+    elapsed = time.time() - start_time
+    print(f"Time taken: {int(elapsed//60)}m {int(elapsed%60)}s")
@@ -0,0 +1,25 @@
+from langchain_community.vectorstores import Chroma
+from embedding_config import STORE_SUFFIX
+
+CHROMA_DIR = "./chroma_db_all" + STORE_SUFFIX
+CHROMA_COLLECTION = "cve_all_collection" + STORE_SUFFIX
+
+# HNSW settings applied when the collection is created (see build_index.py
+# to rebuild an existing collection with them). Embeddings are normalized,
+# so cosine gives the same ranking as the previous L2 default.
+HNSW_METADATA = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 256,
+    "hnsw:search_ef": 128
+}
+
+def open_vectorstore(embeddings=None):
+    """Open (or create) the persisted CVE collection"""
+    
+    return Chroma(
+        persist_directory=CHROMA_DIR,
+        embedding_function=embeddings,
+        collection_name=CHROMA_COLLECTION,
+        collection_metadata=HNSW_METADATA
+    )
@@ -0,0 +1,62 @@
+from langchain_core.documents import Document
+
+# NVD record to Document conversion, shared by the ingest scripts. Kept free
+# of torch and network setup: embed_data.py's Pool workers import this
+# module, and under spawn each worker re-imports whatever it names.
+
+def cve_to_document(cve):
+    """Convert CVE to Document"""
+    
+    cve_id = cve['id']
+    published = cve['published']
+    vuln_status = cve.get('vulnStatus', 'Unknown')
+    description = next(
+        (desc['value'] for desc in cve.get('descriptions', ()) if desc['lang'] == 'en'),
+        ""
+    )
+    
+    cvss_score = None
+    cvss_severity = "N/A"
+    
+    metrics = cve.get('metrics', {})
+    metric_v31 = metrics.get('cvssMetricV31')
+    metric_v2 = metrics.get('cvssMetricV2')
+    if metric_v31:
+        cvss_data = metric_v31[0]['cvssData']
+        cvss_score = cvss_data.get('baseScore')
+        cvss_severity = cvss_data.get('baseSeverity', 'N/A')
+    elif metric_v2:
+        cvss_score = metric_v2[0]['cvssData'].get('baseScore')
+        cvss_severity = metric_v2[0].get('baseSeverity', 'N/A')
+    
+    content = "".join((
+        "CVE ID: ", cve_id,
+        "\nStatus: ", vuln_status,
+        "\nSeverity: ", cvss_severity, " (Score: ", "N/A" if cvss_score is None else str(cvss_score),
+        ")\n\nDescription:\n", description, "\n"
+    ))
+    
+    metadata = {
+        "cve_id": cve_id,
+        "published": published,
+        "lastModified": cve['lastModified'],
+        "vulnStatus": vuln_status,
+        "cvss_severity": cvss_severity,
+        "source": "NVD",
+        "year": int(published[:4])
+    }
+    
+    # Numeric score so Chroma can filter on it ("$gte"); left out when the
+    # CVE has no CVSS metrics, since Chroma metadata can't hold None
+    if cvss_score is not None:
+        metadata["cvss_score"] = float(cvss_score)
+    
+    return Document(page_content=content, metadata=metadata)
+
+def convert_cve(cve):
+    """Convert one CVE in a worker process, returning (document, error)"""
+    
+    try:
+        return cve_to_document(cve), None
+    except Exception as e:
+        return None, f"{cve.get('id', 'unknown')}: {e}"
@@ -1,19 +1,35 @@
 import os
-import requests
+import sys
+import orjson
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from langchain_core.documents import Document
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
+from chroma_store import open_vectorstore
+from langchain_classic.embeddings import CacheBackedEmbeddings
+from langchain_classic.storage import LocalFileStore
+from embedding_model import get_embeddings, embedding_cache_namespace
+from qdrant_store import get_qdrant_client, upsert_cves
+from nvd_client import create_nvd_session, create_nvd_rate_limiter, NVD_API_URL
+from cve_documents import cve_to_document
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 load_dotenv('../.env')
 
+# Shared keep-alive session and rolling-window rate limiter for NVD API calls
+nvd_session = create_nvd_session()
+nvd_rate_limiter = create_nvd_rate_limiter()
+
 # File to track last update time
 LAST_UPDATE_FILE = "last_update.txt"
 
+# Documents embedded and added to the vector store per call
+ADD_BATCH_SIZE = 256
+
+# On-disk cache of document embeddings, keyed by content hash
+EMBEDDING_CACHE_DIR = "./emb_cache"
+
 def get_last_update_time():
     """Get the timestamp of the last update"""
     
@@ -36,19 +52,29 @@ def save_last_update_time(timestamp):
         f.write(timestamp)
     print(f"✓ Saved update timestamp: {timestamp}")
 
+def fetch_page(params):
+    """Fetch one page of NVD results"""
+    
+    nvd_rate_limiter.acquire()
+    response = nvd_session.get(NVD_API_URL, params=params, timeout=30)
+    if response.status_code != 200:
+        raise RuntimeError(f"NVD API error {response.status_code} at startIndex {params['startIndex']}")
+    return orjson.loads(response.content)
+
 def fetch_modified_cves(start_date, end_date):
-    """Fetch CVEs modified between start_date and end_date"""
-    
-    url = "https://services.nvd.nist.gov/rest/json/cves/2.0"
-    
-    nvd_api_key = os.getenv('NVD_API_KEY')
-    headers = {}
-    if nvd_api_key:
-        headers['apiKey'] = nvd_api_key
+    """Fetch CVEs modified between start_date and end_date
+
+    Returns (cves, complete); complete is False if any page failed, in which
+    case the update window must be fetched again on the next run.
+    """
     
     all_cves = []
-    start_index = 0
     results_per_page = 2000
+    base_params = {
+        "lastModStartDate": start_date,
+        "lastModEndDate": end_date,
+        "resultsPerPage": results_per_page
+    }
     
     print(f"\n{'='*60}")
     print(f"Fetching modified CVEs")
@@ -56,142 +82,99 @@ def fetch_modified_cves(start_date, end_date):
     print(f"To:   {end_date}")
     print(f"{'='*60}")
     
-    while True:
-        params = {
-            "lastModStartDate": start_date,
-            "lastModEndDate": end_date,
-            "resultsPerPage": results_per_page,
-            "startIndex": start_index
-        }
-        
-        try:
-            response = requests.get(url, params=params, headers=headers)
+    # First page tells us how many pages there are
+    try:
+        data = fetch_page({**base_params, "startIndex": 0})
+    except Exception as e:
+        print(f"✗ Exception: {e}")
+        return all_cves, False
+    
+    total_results = data.get('totalResults', 0)
+    for vuln in data.get('vulnerabilities', []):
+        all_cves.append(vuln['cve'])
+    print(f"Fetched {len(all_cves)} CVEs | Total: {len(all_cves)}/{total_results}")
+    
+    # Dispatch the remaining pages at once; fetch_page waits for a
+    # rate-limit slot, so request latency overlaps the rate-limit gaps
+    start_indexes = list(range(results_per_page, total_results, results_per_page))
+    complete = True
+    if start_indexes:
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            futures = []
+            for start_index in start_indexes:
+                futures.append(executor.submit(
+                    fetch_page, {**base_params, "startIndex": start_index}
+                ))
             
-            if response.status_code == 200:
-                data = response.json()
-                vulnerabilities = data.get('vulnerabilities', [])
-                
-                if not vulnerabilities:
-                    break
+            for future in futures:
+                try:
+                    vulnerabilities = future.result().get('vulnerabilities', [])
+                except Exception as e:
+                    print(f"✗ Exception: {e}")
+                    complete = False
+                    continue
                 
                 for vuln in vulnerabilities:
                     all_cves.append(vuln['cve'])
-                
-                total_results = data.get('totalResults', 0)
                 print(f"Fetched {len(vulnerabilities)} CVEs | Total: {len(all_cves)}/{total_results}")
-                
-                if start_index + len(vulnerabilities) >= total_results:
-                    break
-                
-                start_index += results_per_page
-                
-                # Rate limiting
-                if nvd_api_key:
-                    time.sleep(0.6)
-                else:
-                    time.sleep(6)
-                    
-            else:
-                print(f"✗ Error: {response.status_code}")
-                break
-                
-        except Exception as e:
-            print(f"✗ Exception: {e}")
-            break
     
     print(f"✓ Total CVEs fetched: {len(all_cves)}")
-    return all_cves
-
-def cve_to_document(cve):
-    """Convert CVE to Document"""
-    
-    description = ""
-    for desc in cve.get('descriptions', []):
-        if desc['lang'] == 'en':
-            description = desc['value']
-            break
-    
-    cvss_score = "N/A"
-    cvss_severity = "N/A"
-    
-    metrics = cve.get('metrics', {})
-    if 'cvssMetricV31' in metrics and len(metrics['cvssMetricV31']) > 0:
-        cvss_data = metrics['cvssMetricV31'][0]['cvssData']
-        cvss_score = cvss_data.get('baseScore', 'N/A')
-        cvss_severity = cvss_data.get('baseSeverity', 'N/A')
-    elif 'cvssMetricV2' in metrics and len(metrics['cvssMetricV2']) > 0:
-        cvss_score = metrics['cvssMetricV2'][0]['cvssData'].get('baseScore', 'N/A')
-        cvss_severity = metrics['cvssMetricV2'][0].get('baseSeverity', 'N/A')
-    
-    content = f"""CVE ID: {cve['id']}
-Status: {cve.get('vulnStatus', 'Unknown')}
-Severity: {cvss_severity} (Score: {cvss_score})
-
-Description:
-{description}
-"""
-    
-    metadata = {
-        "cve_id": cve['id'],
-        "published": cve['published'],
-        "lastModified": cve['lastModified'],
-        "vulnStatus": cve.get('vulnStatus', 'Unknown'),
-        "cvss_score": str(cvss_score),
-        "cvss_severity": cvss_severity,
-        "source": "NVD",
-        "year": cve['published'][:4]
-    }
-    
-    return Document(page_content=content, metadata=metadata)
+    return all_cves, complete
 
 def update_or_add_cves(documents, embeddings):
     """Update existing CVEs or add new ones to the vector store"""
     
     print("\nLoading existing vector store...")
     
-    vectorstore = Chroma(
-        persist_directory="./chroma_db_all",
-        embedding_function=embeddings,
-        collection_name="cve_all_collection"
-    )
+    vectorstore = open_vectorstore(embeddings)
     
     collection = vectorstore._collection
     
+    if not documents:
+        print("No documents to process.")
+        return vectorstore
+    
     print("Processing updates...")
     
+    # CVE IDs are used as vector IDs, so keep only the latest copy of each
+    documents = list({doc.metadata['cve_id']: doc for doc in documents}.values())
+    cve_ids = [doc.metadata['cve_id'] for doc in documents]
+    
+    # Add the new/updated versions in batches sized for the embedding model.
+    # Upsert replaces entries already keyed by CVE ID; older copies under
+    # random UUIDs are deleted only after their replacement is stored, so a
+    # failure never leaves a CVE missing from the store.
+    qdrant_client = get_qdrant_client()
     updated_count = 0
-    added_count = 0
     
-    for i, doc in enumerate(documents, 1):
-        cve_id = doc.metadata['cve_id']
+    for i in range(0, len(documents), ADD_BATCH_SIZE):
+        batch = documents[i:i + ADD_BATCH_SIZE]
+        batch_ids = cve_ids[i:i + ADD_BATCH_SIZE]
+        texts = [doc.page_content for doc in batch]
+        metadatas = [doc.metadata for doc in batch]
+        vectors = embeddings.embed_documents(texts)
         
-        try:
-            # Check if CVE already exists by querying with where filter
-            existing = collection.get(
-                where={"cve_id": cve_id},
-                include=['metadatas']  # Changed from 'ids' to 'metadatas'
-            )
-            
-            if existing and existing['ids']:
-                # CVE exists - delete old version
-                collection.delete(ids=existing['ids'])
-                updated_count += 1
-                action = "Updated"
-            else:
-                # New CVE
-                added_count += 1
-                action = "Added"
-            
-            # Add the new/updated version
-            vectorstore.add_documents([doc])
-            
-            # To indicate progress
-            if i % 100 == 0:
-                print(f"  Processed {i}/{len(documents)} CVEs...")
-            
-        except Exception as e:
-            print(f"✗ Error processing {cve_id}: {e}")
-            continue
+        # Existing versions may be keyed by CVE ID or by an older random UUID
+        existing = collection.get(
+            where={"cve_id": {"$in": batch_ids}},
+            include=['metadatas']
+        )
+        updated_count += len({metadata['cve_id'] for metadata in existing['metadatas']})
+        
+        collection.upsert(ids=batch_ids, embeddings=vectors, documents=texts, metadatas=metadatas)
+        
+        new_ids = set(batch_ids)
+        stale_ids = [vector_id for vector_id in existing['ids'] if vector_id not in new_ids]
+        if stale_ids:
+            collection.delete(ids=stale_ids)
+        
+        # Mirror the new vectors into the quantized Qdrant collection (no re-embedding)
+        if qdrant_client:
+            upsert_cves(qdrant_client, vectors, texts, metadatas)
+        
+        print(f"  Processed {i + len(batch_ids)}/{len(documents)} CVEs...")
+    
+    added_count = len(cve_ids) - updated_count
     
     print(f"  Update complete!")
     print(f"  New CVEs added: {added_count}")
@@ -217,11 +200,14 @@ def daily_update():
     current_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.000")
     
     # Fetch modified CVEs
-    cves = fetch_modified_cves(last_update, current_time)
+    cves, complete = fetch_modified_cves(last_update, current_time)
     
     if not cves:
-        print("\nNo new or modified CVEs found. Database is up to date!")
-        save_last_update_time(current_time)
+        if complete:
+            print("\nNo new or modified CVEs found. Database is up to date!")
+            save_last_update_time(current_time)
+        else:
+            print("\n✗ Fetch failed; last update time not advanced")
         return
     
     # Convert to documents
@@ -238,18 +224,25 @@ def daily_update():
     
     # Initialize embeddings
     print("\nInitializing embeddings...")
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-mpnet-base-v2",
-        model_kwargs={'device': 'mps'},
-        encode_kwargs={'normalize_embeddings': True}
+    # Cache vectors on disk by content hash: most nightly changes touch only
+    # metadata, so unchanged descriptions are not re-embedded
+    embeddings = CacheBackedEmbeddings.from_bytes_store(
+        get_embeddings(),
+        LocalFileStore(EMBEDDING_CACHE_DIR),
+        namespace=embedding_cache_namespace(),
+        key_encoder="sha256"
     )
     
     # Update vector store
     print("\nUpdating vector store...")
     update_or_add_cves(documents, embeddings)
     
-    # Save update timestamp
-    save_last_update_time(current_time)
+    # Save update timestamp only if every page was fetched; otherwise the
+    # next run covers the same window again (re-applying CVEs is harmless)
+    if complete:
+        save_last_update_time(current_time)
+    else:
+        print("\n✗ Some NVD pages failed to fetch; last update time not advanced")
     
     end_time = time.time()
     elapsed = end_time - start_time
@@ -266,4 +259,6 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"\n✗ Update failed: {e}")
         import traceback
-        traceback.print_exc()
\ No newline at end of file
+        traceback.print_exc()
+        # Non-zero so run_daily_update.sh logs the failure
+        sys.exit(1)
\ No newline at end of file
@@ -1,51 +1,145 @@
 import os
-import requests
+import argparse
+import json
+import orjson
+import queue
+import threading
 import time
+import zstandard
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+from tqdm import tqdm
 from dotenv import load_dotenv
-from langchain_core.documents import Document
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
+from chroma_store import CHROMA_DIR, open_vectorstore
+from nvd_client import create_nvd_session, create_nvd_rate_limiter, NVD_API_URL
+from cve_documents import convert_cve
 
 # Disable tokenizer parallelism warning
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 load_dotenv('../.env')
 
-def fetch_all_cves():
-    """Fetch ALL CVEs using pagination (no date filter)"""
+# Maximum page size allowed by the NVD API
+RESULTS_PER_PAGE = 2000
+
+# Written after each stored batch so an interrupted ingest resumes from the
+# first NVD page that is not fully stored, without scanning the collection
+PROGRESS_FILE = os.path.join(CHROMA_DIR, ".progress")
+
+# Raw NVD pages, zstd-compressed and keyed by startIndex, so re-running the
+# ingest reads from disk instead of the rate-limited API. Only full pages are
+# cached: the last, partial page grows as CVEs are published, so it is
+# always fetched again. --refresh ignores the cache for a whole run.
+NVD_CACHE_DIR = "./nvd_cache"
+
+# NVD pages requested at once; the rate limiter still caps the request rate,
+# this just hides response latency behind the other requests in flight
+FETCH_CONCURRENCY = 5
+
+# Keep-alive NVD session (retries 429/5xx with backoff) and rolling-window
+# rate limiter shared by every page request
+nvd_session = create_nvd_session(pool_size=FETCH_CONCURRENCY, retries=5, backoff_factor=1)
+nvd_rate_limiter = create_nvd_rate_limiter()
+
+def fetch_page_data(start_index, results_per_page, use_cache=True):
+    """Return one parsed NVD page, from the disk cache or the API"""
+    
+    cache_path = os.path.join(NVD_CACHE_DIR, f"page_{start_index}_{results_per_page}.json.zst")
+    if use_cache and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            data = orjson.loads(zstandard.ZstdDecompressor().decompress(f.read()))
+        # Partial pages cached by older runs are stale, so fetch them again
+        if len(data.get('vulnerabilities', [])) == results_per_page:
+            return data
+    
+    params = {
+        "resultsPerPage": results_per_page,
+        "startIndex": start_index
+    }
+    
+    # Wait for a rate-limit slot only when actually calling the API
+    nvd_rate_limiter.acquire()
+    response = nvd_session.get(NVD_API_URL, params=params, timeout=60)
+    if response.status_code != 200:
+        raise RuntimeError(f"NVD API error {response.status_code}")
     
-    url = "https://services.nvd.nist.gov/rest/json/cves/2.0"
+    data = orjson.loads(response.content)
+    if len(data.get('vulnerabilities', [])) < results_per_page:
+        return data
+    
+    # Write to a temp file first so an interrupted run never leaves a partial page
+    os.makedirs(NVD_CACHE_DIR, exist_ok=True)
+    with open(cache_path + ".tmp", 'wb') as f:
+        f.write(zstandard.ZstdCompressor(level=3).compress(response.content))
+    os.replace(cache_path + ".tmp", cache_path)
+    
+    return data
+
+def fetch_cve_page(start_index, results_per_page, use_cache=True):
+    """Fetch one page of CVEs"""
+    
+    data = fetch_page_data(start_index, results_per_page, use_cache)
+    return [vuln['cve'] for vuln in data.get('vulnerabilities', [])]
+
+def load_progress():
+    """Return (next start index, CVEs stored so far) from the checkpoint, or (None, 0)"""
+    
+    if not os.path.exists(PROGRESS_FILE):
+        return None, 0
+    
+    with open(PROGRESS_FILE, 'r') as f:
+        progress = json.load(f)
+    print(f"Resuming from checkpoint: {progress['embedded']:,} CVEs stored, next page at startIndex {progress['next_start_index']:,}")
+    return progress['next_start_index'], progress['embedded']
+
+def save_progress(next_start_index, embedded):
+    """Record that every NVD page before next_start_index is stored"""
+    
+    # Written to a temp file and swapped in, so a crash mid-write can't
+    # leave a truncated checkpoint behind
+    tmp_path = PROGRESS_FILE + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({
+            "next_start_index": next_start_index,
+            "embedded": embedded,
+            "updated": time.strftime("%Y-%m-%dT%H:%M:%S")
+        }, f)
+    os.replace(tmp_path, PROGRESS_FILE)
+
+def iter_cve_pages(first_index=0, status=None, refresh=False):
+    """Fetch ALL CVEs using pagination (no date filter), yielding one page at a time
+
+    status['complete'] is set to True only if every page up to totalResults
+    was fetched; a failed request ends the generator early without it.
+    """
+    
+    if status is None:
+        status = {}
+    status['complete'] = False
     
     nvd_api_key = os.getenv('NVD_API_KEY')
-    headers = {}
     if nvd_api_key:
-        headers['apiKey'] = nvd_api_key
         print("Using NVD API key (50 requests per 30 seconds)")
     else:
         print("No API key found (5 requests per 30 seconds)")
     
-    all_cves = []
-    start_index = 0
-    results_per_page = 2000  # Maximum allowed as per NVD API
+    fetched = 0
+    results_per_page = RESULTS_PER_PAGE
     
     print(f"\n{'='*60}")
     print("FETCHING ALL CVEs FROM NVD")
     print(f"{'='*60}")
     
-    # First request to get total count
-    params = {
-        "resultsPerPage": results_per_page,
-        "startIndex": 0
-    }
-    
+    # First request to get total count, always from the API so totalResults
+    # includes CVEs published since the pages on disk were cached
     print("Making initial request to get total CVE count...")
-    response = requests.get(url, params=params, headers=headers)
-    
-    if response.status_code != 200:
-        print(f"✗ Error: {response.status_code}")
-        return []
+    try:
+        data = fetch_page_data(first_index, results_per_page, use_cache=False)
+    except Exception as e:
+        print(f"✗ Error: {e}")
+        return
     
-    data = response.json()
     total_results = data.get('totalResults', 0)
     
     print(f"\n✓ Total CVEs in database: {total_results:,}")
@@ -61,122 +155,87 @@ def fetch_all_cves():
     print(f"  Estimated fetch time: {int(estimated_time//60)} min {int(estimated_time%60)} sec")
     print(f"\nStarting fetch...\n")
     
-    # Process first batch
-    vulnerabilities = data.get('vulnerabilities', [])
-    for vuln in vulnerabilities:
-        all_cves.append(vuln['cve'])
-    
-    print(f"[Page 1] Fetched {len(vulnerabilities):,} CVEs | Total: {len(all_cves):,}/{total_results:,}")
-    
-    start_index += results_per_page
-    page_num = 2
-    
-    # Fetch remaining pages
-    while start_index < total_results:
-        params = {
-            "resultsPerPage": results_per_page,
-            "startIndex": start_index
-        }
+    # One progress bar for the whole fetch instead of a line per page
+    fetch_bar = tqdm(total=total_results, initial=first_index, unit='CVE', desc='Fetched', position=0)
+    try:
+        # Process first batch
+        vulnerabilities = data.get('vulnerabilities', [])
+        fetched += len(vulnerabilities)
+        fetch_bar.update(len(vulnerabilities))
+        page_num = first_index // results_per_page + 1
+        page = [vuln['cve'] for vuln in vulnerabilities]
+        del data, vulnerabilities  # Hold only the current page while it is processed
+        yield page
         
-        try:
-            response = requests.get(url, params=params, headers=headers)
+        # Fetch remaining pages, keeping up to FETCH_CONCURRENCY requests in
+        # flight. Pages are still yielded in order, and at most that many are
+        # held in memory ahead of the consumer.
+        start_indexes = iter(range(first_index + results_per_page, total_results, results_per_page))
+        page_num += 1
+        
+        with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+            in_flight = deque()
+            for start_index in start_indexes:
+                in_flight.append(executor.submit(fetch_cve_page, start_index, results_per_page, not refresh))
+                if len(in_flight) == FETCH_CONCURRENCY:
+                    break
             
-            if response.status_code == 200:
-                data = response.json()
-                vulnerabilities = data.get('vulnerabilities', [])
-                
-                if not vulnerabilities:
+            complete = True
+            while in_flight:
+                try:
+                    page = in_flight.popleft().result()
+                except Exception as e:
+                    tqdm.write(f"✗ Exception on page {page_num}: {e}")
+                    complete = False
                     break
                 
-                for vuln in vulnerabilities:
-                    all_cves.append(vuln['cve'])
+                if not page:
+                    tqdm.write(f"✗ Empty page {page_num} before totalResults was reached")
+                    complete = False
+                    break
                 
-                progress = (len(all_cves) / total_results) * 100
-                print(f"[Page {page_num}] Fetched {len(vulnerabilities):,} CVEs | Total: {len(all_cves):,}/{total_results:,} ({progress:.1f}%)")
+                # Refill the window before handing the page to the consumer
+                next_index = next(start_indexes, None)
+                if next_index is not None:
+                    in_flight.append(executor.submit(fetch_cve_page, next_index, results_per_page, not refresh))
                 
-                start_index += results_per_page
+                fetched += len(page)
+                fetch_bar.update(len(page))
+                yield page
+                del page
                 page_num += 1
-                
-                # Rate limiting
-                if nvd_api_key:
-                    time.sleep(0.6)  # Safe with API key
-                else:
-                    time.sleep(6)    # Safe without API key
-                    
-            else:
-                print(f"✗ Error on page {page_num}: {response.status_code}")
-                break
-                
-        except Exception as e:
-            print(f"✗ Exception on page {page_num}: {e}")
-            break
+            
+            for future in in_flight:
+                future.cancel()
+    finally:
+        fetch_bar.close()
+    
+    status['complete'] = complete
     
     print(f"\n{'='*60}")
-    print(f"FETCH COMPLETE!")
-    print(f"  Total CVEs fetched: {len(all_cves):,}")
+    print("FETCH COMPLETE!" if complete else "FETCH STOPPED EARLY")
+    print(f"  Total CVEs fetched: {fetched:,}")
     print(f"{'='*60}")
-    
-    return all_cves
-
-def cve_to_document(cve):
-    """Convert CVE to Document"""
-    
-    description = ""
-    for desc in cve.get('descriptions', []):
-        if desc['lang'] == 'en':
-            description = desc['value']
-            break
-    
-    cvss_score = "N/A"
-    cvss_severity = "N/A"
-    
-    metrics = cve.get('metrics', {})
-    if 'cvssMetricV31' in metrics and len(metrics['cvssMetricV31']) > 0:
-        cvss_data = metrics['cvssMetricV31'][0]['cvssData']
-        cvss_score = cvss_data.get('baseScore', 'N/A')
-        cvss_severity = cvss_data.get('baseSeverity', 'N/A')
-    elif 'cvssMetricV2' in metrics and len(metrics['cvssMetricV2']) > 0:
-        cvss_score = metrics['cvssMetricV2'][0]['cvssData'].get('baseScore', 'N/A')
-        cvss_severity = metrics['cvssMetricV2'][0].get('baseSeverity', 'N/A')
-    
-    content = f"""CVE ID: {cve['id']}
-Status: {cve.get('vulnStatus', 'Unknown')}
-Severity: {cvss_severity} (Score: {cvss_score})
-
-Description:
-{description}
-"""
-    
-    metadata = {
-        "cve_id": cve['id'],
-        "published": cve['published'],
-        "lastModified": cve['lastModified'],
-        "vulnStatus": cve.get('vulnStatus', 'Unknown'),
-        "cvss_score": str(cvss_score),
-        "cvss_severity": cvss_severity,
-        "source": "NVD",
-        "year": cve['published'][:4]
-    }
-    
-    return Document(page_content=content, metadata=metadata)
 
-def embed_and_store_batch(documents, embeddings, vectorstore=None):
-    """Embed and store documents in batches"""
-    
-    if vectorstore is None:
-        print("Creating new ChromaDB vector store...")
-        vectorstore = Chroma.from_documents(
-            documents=documents,
-            embedding=embeddings,
-            persist_directory="./chroma_db_all",
-            collection_name="cve_all_collection"
-        )
-    else:
-        vectorstore.add_documents(documents)
-    
-    return vectorstore
+def embed_and_store_batch(documents, embeddings, collection):
+    """Embed a batch of documents in one call and write it to the collection"""
+    
+    from embedding_model import encode_documents
+    
+    texts = [doc.page_content for doc in documents]
+    vectors = encode_documents(embeddings, texts)
+    
+    # One write per batch with precomputed vectors, so Chroma does no
+    # embedding work. CVE IDs double as vector IDs so lookups and deletes
+    # are by primary key.
+    collection.upsert(
+        ids=[doc.metadata['cve_id'] for doc in documents],
+        embeddings=vectors,
+        documents=texts,
+        metadatas=[doc.metadata for doc in documents]
+    )
 
-def process_all_cves():
+def process_all_cves(confirm=True, refresh=False):
     """Process all CVEs from NVD database"""
     
     print("="*60)
@@ -186,116 +245,183 @@ def process_all_cves():
     print("\nWARNING: This will take several hours!")
     print("The process will:")
     print("  1. Fetch all CVEs via pagination")
-    print("  2. Convert to documents")
+    print("  2. Convert each page to documents")
     print("  3. Embed using HuggingFace (local M3)")
     print("  4. Store in ChromaDB")
-    print("\nPress Ctrl+C to cancel within 5 seconds...")
+    print("Fetching runs in the background while earlier pages are embedded.")
     
-    try:
-        time.sleep(5)
-    except KeyboardInterrupt:
-        print("\nCancelled by user")
-        return
+    # Unattended runs (--yes or CVE_INGEST_CONFIRM=0) skip the countdown
+    if confirm:
+        print("\nPress Ctrl+C to cancel within 5 seconds...")
+        try:
+            time.sleep(5)
+        except KeyboardInterrupt:
+            print("\nCancelled by user")
+            return
     
-    # Fetch all CVEs
+    # Initialize embeddings
     print("\n" + "="*60)
-    print("STEP 1: FETCHING ALL CVEs")
+    print("STEP 1: INITIALIZING EMBEDDINGS")
     print("="*60)
-    fetch_start = time.time()
-    
-    cves = fetch_all_cves()
     
-    fetch_end = time.time()
-    fetch_time = fetch_end - fetch_start
-    print(f"\n✓ Fetch completed in {int(fetch_time//60)}m {int(fetch_time%60)}s")
+    # Imported here rather than at the top: under spawn (the macOS default)
+    # each Pool worker re-runs this module's top level, and the workers only
+    # need cve_documents, not torch and the model stack
+    from embedding_model import get_embeddings
     
-    if not cves:
-        print("No CVEs fetched. Exiting.")
-        return
+    embeddings = get_embeddings()
+    print("Embeddings initialized")
     
-    # Convert to documents
+    # Fetch + convert (producer thread) and embed + store (this thread) overlap,
+    # so the rate-limit sleeps between NVD pages are spent embedding
     print("\n" + "="*60)
-    print("STEP 2: CONVERTING TO DOCUMENTS")
+    print("STEP 2: FETCHING, CONVERTING, EMBEDDING AND STORING")
     print("="*60)
     
-    documents = []
-    failed_conversions = 0
-    
-    for i, cve in enumerate(cves, 1):
+    collection = open_vectorstore(embeddings)._collection
+    
+    # Resume: skip the pages a checkpoint says are stored, or, for a store
+    # built without one, skip CVEs that are already in the collection
+    first_index, previously_embedded = load_progress()
+    existing_ids = set()
+    if first_index is None:
+        first_index = 0
+        if collection.count():
+            # Matched on the cve_id metadata, not the vector IDs: stores built
+            # before CVE IDs were used as vector IDs have random UUIDs there
+            existing = collection.get(include=['metadatas'])
+            existing_ids = {metadata['cve_id'] for metadata in existing['metadatas'] if metadata and 'cve_id' in metadata}
+            del existing
+            print(f"Skipping {len(existing_ids):,} CVEs already in the vector store")
+    
+    document_queue = queue.Queue(maxsize=4)
+    conversion_stats = {'converted': 0, 'failed': 0, 'skipped': 0}
+    fetch_status = {'complete': False}
+    
+    def fetch_and_convert():
         try:
-            doc = cve_to_document(cve)
-            documents.append(doc)
-            
-            if i % 1000 == 0:
-                print(f"Converted {i:,}/{len(cves):,} CVEs...")
-                
-        except Exception as e:
-            failed_conversions += 1
-            if failed_conversions <= 10:  # Only print first 10 errors
-                print(f"✗ Error converting {cve.get('id', 'unknown')}: {e}")
-    
-    print(f"\n✓ Conversion complete!")
-    print(f"  Successful: {len(documents):,}")
-    print(f"  Failed: {failed_conversions:,}")
-    
-    # Initialize embeddings
-    print("\n" + "="*60)
-    print("STEP 3: INITIALIZING EMBEDDINGS")
-    print("="*60)
-    
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-mpnet-base-v2",
-        model_kwargs={'device': 'mps'},
-        encode_kwargs={'normalize_embeddings': True}
-    )
-    print("Embeddings initialized (using M3 GPU)")
-    
-    # Embed and store
-    print("\n" + "="*60)
-    print("STEP 4: EMBEDDING AND STORING")
-    print("="*60)
+            # Pages are converted across all CPU cores as they arrive
+            with Pool(processes=os.cpu_count()) as pool:
+                for page in iter_cve_pages(first_index, fetch_status, refresh):
+                    if existing_ids:
+                        page_size = len(page)
+                        page = [cve for cve in page if cve['id'] not in existing_ids]
+                        conversion_stats['skipped'] += page_size - len(page)
+                    documents = []
+                    for doc, error in pool.imap_unordered(convert_cve, page, chunksize=500):
+                        if error is None:
+                            documents.append(doc)
+                            continue
+                        conversion_stats['failed'] += 1
+                        if conversion_stats['failed'] <= 10:  # Only print first 10 errors
+                            tqdm.write(f"✗ Error converting {error}")
+                    conversion_stats['converted'] += len(documents)
+                    # Raw JSON is dropped as soon as its documents are queued
+                    del page
+                    document_queue.put(documents)
+        finally:
+            document_queue.put(None)
+    
+    # Daemon thread so Ctrl+C in the main thread ends the whole process
+    fetcher = threading.Thread(target=fetch_and_convert, daemon=True)
+    fetcher.start()
     
     embed_start = time.time()
-    vectorstore = None
-    batch_size = 100
-    total_batches = (len(documents) - 1) // batch_size + 1
-    
-    print(f"Processing {len(documents):,} documents in batches of {batch_size}")
-    print(f"Total batches: {total_batches:,}\n")
-    
-    for i in range(0, len(documents), batch_size):
-        batch = documents[i:i+batch_size]
-        batch_num = i//batch_size + 1
+    # Large batches (spanning several NVD pages) amortize Chroma's
+    # per-write overhead and give the model's length-sorted micro-batches
+    # (encode_kwargs batch_size) a wide window to sort in
+    batch_size = 5000
+    batch_num = 0
+    embedded = 0
+    pending = []
+    
+    # Page boundaries (as running document counts) for the checkpoint: a
+    # page counts as stored once every document up to its end is stored
+    received = 0
+    page_ends = deque()
+    pages_stored = 0
+    checkpointing = True
+    embed_bar = tqdm(unit='CVE', desc='Embedded', position=1)
+    
+    while True:
+        documents = document_queue.get()
+        done = documents is None
+        if not done:
+            pending.extend(documents)
+            received += len(documents)
+            page_ends.append(received)
+            del documents
         
-        try:
-            vectorstore = embed_and_store_batch(batch, embeddings, vectorstore)
-            progress = (batch_num / total_batches) * 100
-            print(f"[Batch {batch_num:,}/{total_batches:,}] Embedded {len(batch)} documents ({progress:.1f}%)")
+        # Store full batches as they fill up, and whatever is left at the end
+        while pending and (len(pending) >= batch_size or done):
+            batch = pending[:batch_size]
+            del pending[:batch_size]
+            batch_num += 1
             
-        except KeyboardInterrupt:
-            print(f"\n\n⚠ Interrupted by user at batch {batch_num}")
-            print(f"Progress saved: {batch_num * batch_size:,} CVEs embedded")
-            return
-        except Exception as e:
-            print(f"✗ Error on batch {batch_num}: {e}")
+            try:
+                embed_and_store_batch(batch, embeddings, collection)
+                embedded += len(batch)
+                embed_bar.update(len(batch))
+                
+                if checkpointing:
+                    while page_ends and page_ends[0] <= embedded:
+                        page_ends.popleft()
+                        pages_stored += 1
+                    save_progress(first_index + pages_stored * RESULTS_PER_PAGE, previously_embedded + embedded)
+                
+            except KeyboardInterrupt:
+                embed_bar.close()
+                print(f"\n\n⚠ Interrupted by user at batch {batch_num}")
+                print(f"Progress saved: {embedded:,} CVEs embedded")
+                return
+            except Exception as e:
+                tqdm.write(f"✗ Error on batch {batch_num}: {e}")
+                # Later pages may be stored, but the checkpoint must not skip this batch
+                checkpointing = False
+        
+        if done:
+            break
+    
+    embed_bar.close()
+    
+    # Only a run that fetched every page and stored every batch is finished.
+    # It needs no checkpoint; the next run skips existing IDs instead
+    complete = fetch_status['complete'] and checkpointing
+    if complete and os.path.exists(PROGRESS_FILE):
+        os.remove(PROGRESS_FILE)
     
     embed_end = time.time()
     embed_time = embed_end - embed_start
     
+    if embedded == 0 and complete:
+        print("No CVEs embedded. Exiting.")
+        return
+    
     print("\n" + "="*60)
-    print("EMBEDDING COMPLETE!")
+    if complete:
+        print("EMBEDDING COMPLETE!")
+    else:
+        print("EMBEDDING STOPPED EARLY - run again to resume from the checkpoint")
     print("="*60)
-    print(f"Total CVEs embedded: {len(documents):,}")
-    print(f"Fetch time: {int(fetch_time//60)}m {int(fetch_time%60)}s")
-    print(f"Embed time: {int(embed_time//60)}m {int(embed_time%60)}s")
-    print(f"Vector store: ./chroma_db_all")
+    print(f"Documents converted: {conversion_stats['converted']:,} (failed: {conversion_stats['failed']:,}, already stored: {conversion_stats['skipped']:,})")
+    print(f"CVEs embedded this run: {embedded:,} ({previously_embedded + embedded:,} including earlier runs)")
+    print(f"Fetch + embed time: {int(embed_time//60)}m {int(embed_time%60)}s")
+    print(f"Vector store: {CHROMA_DIR}")
     print("="*60)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed the entire NVD database into ChromaDB")
+    parser.add_argument('--yes', action='store_true', help="start immediately, without the 5 second cancel window")
+    parser.add_argument('--refresh', action='store_true', help="fetch every page from NVD instead of the on-disk page cache")
+    args = parser.parse_args()
+    
     overall_start = time.time()
     
     try:
-        process_all_cves()
+        process_all_cves(
+            confirm=not args.yes and os.getenv('CVE_INGEST_CONFIRM') != '0',
+            refresh=args.refresh
+        )
     except KeyboardInterrupt:
         print("\n\nProcess interrupted by user")
     finally:
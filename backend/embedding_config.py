@@ -0,0 +1,20 @@
+import os
+from dotenv import load_dotenv
+
+# Embedding model settings, kept free of torch so the store modules (and
+# build_index.py / migrate_to_qdrant.py) can import them cheaply.
+# Read at import time, before the scripts load .env themselves
+load_dotenv('../.env')
+
+DEFAULT_EMBED_MODEL = "sentence-transformers/all-mpnet-base-v2"
+
+# CVE_EMBED_MODEL swaps in a lighter model, e.g. all-MiniLM-L6-v2 (6 layers,
+# 384 dims) for faster bulk ingest. Vectors from different models can't be
+# mixed, so changing it means re-running embed_data.py; the new vectors go
+# to a separate store named after the model (STORE_SUFFIX).
+EMBED_MODEL_NAME = os.getenv('CVE_EMBED_MODEL', DEFAULT_EMBED_MODEL)
+
+if EMBED_MODEL_NAME == DEFAULT_EMBED_MODEL:
+    STORE_SUFFIX = ""
+else:
+    STORE_SUFFIX = "_" + EMBED_MODEL_NAME.split('/')[-1].lower().replace('-', '_').replace('.', '_')
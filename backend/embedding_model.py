@@ -0,0 +1,179 @@
+import os
+import threading
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import LRUCache
+from functools import lru_cache
+from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_community.embeddings import InfinityEmbeddings
+from langchain_core.embeddings import Embeddings
+from embedding_config import EMBED_MODEL_NAME
+
+# EMBED_BACKEND=onnx runs a quantized int8 ONNX export of the model with
+# ONNX Runtime on the CPU instead of fp32 PyTorch on the GPU
+EMBED_BACKEND = os.getenv('EMBED_BACKEND', 'torch')
+EMBED_ONNX_FILE = os.getenv('EMBED_ONNX_FILE', 'onnx/model_qint8_arm64.onnx')
+
+# EMBED_FP16=1 runs the PyTorch model in fp16 on MPS (half the memory
+# traffic of fp32). Opt-in: check that its vectors' cosine similarity to
+# the fp32 ones stays close to 1 before mixing them into an fp32 store
+EMBED_FP16 = os.getenv('EMBED_FP16') == '1'
+
+@lru_cache(maxsize=1)
+def get_embeddings():
+    """Load the embedding model used for the CVE vector store
+
+    The instance is built once per process and shared by every caller, so
+    the model weights are only loaded onto the device once.
+
+    If INFINITY_API_URL is set, embeddings are computed by an Infinity server
+    (dynamic batching, fp16), e.g. started with:
+        infinity_emb v2 --model-id sentence-transformers/all-mpnet-base-v2 --batch-size 64 --dtype float16
+    (the served model must match EMBED_MODEL_NAME).
+    Otherwise the model runs in-process: on the M3 GPU, or with ONNX Runtime
+    when EMBED_BACKEND=onnx. The model repo ships int8 exports such as
+    onnx/model_qint8_arm64.onnx (Apple silicon) and
+    onnx/model_qint8_avx512.onnx (x86), selected with EMBED_ONNX_FILE.
+    """
+
+    infinity_url = os.getenv('INFINITY_API_URL')
+    if infinity_url:
+        print(f"Using Infinity embedding server at {infinity_url}")
+        return InfinityEmbeddings(
+            model=EMBED_MODEL_NAME,
+            infinity_api_url=infinity_url
+        )
+
+    if EMBED_BACKEND == 'onnx':
+        print(f"Using ONNX Runtime embedding backend ({EMBED_ONNX_FILE})")
+        model_kwargs = {
+            'device': 'cpu',
+            'backend': 'onnx',
+            'model_kwargs': {'file_name': EMBED_ONNX_FILE}
+        }
+    elif EMBED_FP16:
+        model_kwargs = {'device': 'mps', 'model_kwargs': {'torch_dtype': torch.float16}}
+    else:
+        model_kwargs = {'device': 'mps'}
+
+    return HuggingFaceEmbeddings(
+        model_name=EMBED_MODEL_NAME,
+        model_kwargs=model_kwargs,
+        # sentence-transformers sorts each call's texts by length before
+        # splitting them into micro-batches, so large calls pad very little
+        encode_kwargs={'normalize_embeddings': True, 'batch_size': 128}
+    )
+
+def embedding_cache_namespace():
+    """Name for cached document vectors: the model plus the backend and precision producing them
+
+    LocalFileStore keys may only contain letters, digits and _ . - /, so the
+    parts are joined with "/", and the trailing "/" keeps the content hash
+    separate from the variant.
+    """
+    
+    if os.getenv('INFINITY_API_URL'):
+        variant = "infinity"
+    elif EMBED_BACKEND == 'onnx':
+        variant = "onnx-" + EMBED_ONNX_FILE.replace('/', '_').replace('.', '_')
+    elif EMBED_FP16:
+        variant = "torch-fp16"
+    else:
+        variant = "torch-fp32"
+    return f"{EMBED_MODEL_NAME}/{variant}/"
+
+class QueryCachedEmbeddings(Embeddings):
+    """Embeddings wrapper that keeps recent query vectors in an LRU cache
+
+    Repeated questions (example queries, chatbot follow-ups) skip the
+    transformer forward pass. Keys keep their case, since CVE_EMBED_MODEL
+    may be case-sensitive. Document embedding is passed through.
+    """
+    
+    def __init__(self, embeddings, maxsize=1024):
+        self.embeddings = embeddings
+        self.query_cache = LRUCache(maxsize=maxsize)
+        self.lock = threading.Lock()
+    
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+    
+    def embed_query(self, text):
+        key = text.strip()
+        with self.lock:
+            vector = self.query_cache.get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            with self.lock:
+                self.query_cache[key] = vector
+        return vector
+
+def encode_documents(embeddings, texts):
+    """Embed texts for bulk ingest, calling sentence-transformers directly when possible
+
+    Returns a numpy array for in-process models, which Chroma accepts as is,
+    skipping LangChain's per-vector list conversion. Like
+    SentenceTransformer.encode, texts are embedded in length-sorted
+    micro-batches, but the next micro-batch is tokenized on a worker thread
+    (the fast tokenizer runs in Rust, off the GIL) while the device is
+    busy with the current one.
+    """
+    
+    if not isinstance(embeddings, HuggingFaceEmbeddings) or not texts:
+        return embeddings.embed_documents(texts)
+    
+    model = embeddings._client
+    batch_size = embeddings.encode_kwargs.get('batch_size', 32)
+    normalize = embeddings.encode_kwargs.get('normalize_embeddings', False)
+    
+    # Longest first, as sentence-transformers does, so each micro-batch
+    # pads only to similar lengths
+    order = np.argsort([-len(text) for text in texts], kind='stable')
+    sorted_texts = [texts[i] for i in order]
+    batches = [sorted_texts[i:i + batch_size] for i in range(0, len(sorted_texts), batch_size)]
+    
+    chunks = []
+    with ThreadPoolExecutor(max_workers=1) as tokenizer_pool:
+        next_features = tokenizer_pool.submit(model.tokenize, batches[0])
+        for i in range(len(batches)):
+            features = next_features.result()
+            if i + 1 < len(batches):
+                next_features = tokenizer_pool.submit(model.tokenize, batches[i + 1])
+            
+            features = {key: value.to(model.device) for key, value in features.items()}
+            with torch.inference_mode():
+                vectors = model.forward(features)['sentence_embedding']
+                if normalize:
+                    vectors = torch.nn.functional.normalize(vectors, p=2, dim=1)
+            chunks.append(vectors.float().cpu().numpy())
+    
+    # Back to the caller's order
+    result = np.empty((len(texts), chunks[0].shape[1]), dtype=np.float32)
+    result[order] = np.concatenate(chunks)
+    return result
+
+def compile_embeddings(embeddings):
+    """Compile the in-process model with torch.compile and warm it up
+
+    The compile cost is paid here at startup instead of on the first user
+    query. torch.compile on MPS still has rough edges, so on any failure the
+    eager model is kept.
+    """
+    
+    if not isinstance(embeddings, HuggingFaceEmbeddings) or EMBED_BACKEND == 'onnx':
+        return embeddings
+    
+    transformer = embeddings._client[0]
+    eager_model = transformer.auto_model
+    
+    try:
+        print("Compiling embedding model...")
+        transformer.auto_model = torch.compile(eager_model, backend="aot_eager", dynamic=True)
+        embeddings.embed_query("warmup")
+        print("✓ Embedding model compiled")
+    except Exception as e:
+        print(f"✗ Could not compile embedding model, using eager mode: {e}")
+        transformer.auto_model = eager_model
+    
+    return embeddings
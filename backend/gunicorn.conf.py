@@ -0,0 +1,21 @@
+import os
+
+# Production server for the CyberRAG API. Run from the backend directory:
+#   gunicorn -c gunicorn.conf.py api:app
+#
+# gevent workers multiplex the I/O-bound OpenAI and NVD calls, so one slow
+# /api/query no longer blocks every other request.
+
+bind = "0.0.0.0:5001"
+# One worker by default: Chroma's PersistentClient is not safe to share
+# between processes, and each worker loads its own model and index. Only
+# raise WEB_CONCURRENCY with Chroma running in client/server mode.
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+worker_class = "gevent"
+worker_connections = 256
+timeout = 120
+
+def post_worker_init(worker):
+    """Load embeddings, vector store and LLM once in each worker"""
+    from api import initialize_system
+    initialize_system()
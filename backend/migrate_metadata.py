@@ -0,0 +1,50 @@
+import time
+import chromadb
+from chroma_store import CHROMA_DIR, CHROMA_COLLECTION
+
+def migrate_metadata(batch_size=1000):
+    """Convert string cvss_score and year metadata to numbers in place
+
+    Stores embedded before scores were stored as numbers hold them as strings,
+    which Chroma's numeric filters ("$gt", "$gte") never match. Only metadata
+    is rewritten; embeddings and documents are left as they are. Scores of
+    "N/A" stay strings, since those CVEs have no score to filter on.
+    """
+    
+    client = chromadb.PersistentClient(path=CHROMA_DIR)
+    collection = client.get_collection(CHROMA_COLLECTION)
+    total = collection.count()
+    
+    print(f"Checking metadata of {total:,} CVEs")
+    
+    updated = 0
+    for offset in range(0, total, batch_size):
+        batch = collection.get(limit=batch_size, offset=offset, include=['metadatas'])
+        
+        ids = []
+        metadatas = []
+        for vector_id, metadata in zip(batch['ids'], batch['metadatas']):
+            changes = {}
+            score = metadata.get('cvss_score')
+            if isinstance(score, str) and score != "N/A":
+                changes['cvss_score'] = float(score)
+            year = metadata.get('year')
+            if isinstance(year, str):
+                changes['year'] = int(year)
+            if changes:
+                ids.append(vector_id)
+                metadatas.append(changes)
+        
+        # update() merges these keys into the existing metadata
+        if ids:
+            collection.update(ids=ids, metadatas=metadatas)
+            updated += len(ids)
+        print(f"  Checked {min(offset + batch_size, total):,}/{total:,} CVEs, updated {updated:,}...")
+    
+    print(f"✓ Metadata migrated: {updated:,} CVEs updated")
+
+if __name__ == "__main__":
+    start_time = time.time()
+    migrate_metadata()
+    elapsed = time.time() - start_time
+    print(f"Time taken: {int(elapsed//60)}m {int(elapsed%60)}s")
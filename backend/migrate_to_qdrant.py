@@ -0,0 +1,40 @@
+import time
+from dotenv import load_dotenv
+from chroma_store import open_vectorstore, CHROMA_DIR
+from qdrant_store import get_qdrant_client, upsert_cves, QDRANT_COLLECTION
+
+load_dotenv('../.env')
+
+def migrate(batch_size=1000):
+    """Copy every CVE (with its stored embedding) from ChromaDB into Qdrant"""
+    
+    client = get_qdrant_client()
+    if client is None:
+        print("✗ QDRANT_URL is not set. Add it to your .env file first.")
+        return
+    
+    # Only stored embeddings are read, so no embedding model is needed
+    vectorstore = open_vectorstore()
+    collection = vectorstore._collection
+    total = collection.count()
+    
+    print(f"Migrating {total:,} CVEs from {CHROMA_DIR} to Qdrant '{QDRANT_COLLECTION}'")
+    
+    migrated = 0
+    for offset in range(0, total, batch_size):
+        batch = collection.get(
+            limit=batch_size,
+            offset=offset,
+            include=['embeddings', 'documents', 'metadatas']
+        )
+        upsert_cves(client, batch['embeddings'], batch['documents'], batch['metadatas'])
+        migrated += len(batch['ids'])
+        print(f"  Migrated {migrated:,}/{total:,} CVEs...")
+    
+    print(f"✓ Migration complete: {migrated:,} CVEs")
+
+if __name__ == "__main__":
+    start_time = time.time()
+    migrate()
+    elapsed = time.time() - start_time
+    print(f"Time taken: {int(elapsed//60)}m {int(elapsed%60)}s")
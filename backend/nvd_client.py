@@ -0,0 +1,66 @@
+import os
+import threading
+import time
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+NVD_API_URL = "https://services.nvd.nist.gov/rest/json/cves/2.0"
+
+def create_nvd_session(pool_size=16, retries=3, backoff_factor=0.5):
+    """Create a keep-alive session for the NVD API
+
+    Reusing one session keeps the TLS connection to services.nvd.nist.gov
+    open across pages and requests. Transient errors are retried with backoff.
+    """
+    
+    session = requests.Session()
+    
+    nvd_api_key = os.getenv('NVD_API_KEY')
+    if nvd_api_key:
+        session.headers['apiKey'] = nvd_api_key
+    
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504])
+    )
+    session.mount('https://', adapter)
+    
+    return session
+
+class RateLimiter:
+    """Allow at most max_calls calls in any rolling window of period seconds
+
+    Calls go through immediately until the window is full, then acquire()
+    blocks just until the oldest call leaves the window. NVD enforces its
+    limit over a rolling 30 second window, which this mirrors exactly.
+    """
+    
+    def __init__(self, max_calls, period):
+        self.max_calls = max_calls
+        self.period = period
+        self.calls = deque()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.calls and now - self.calls[0] >= self.period:
+                    self.calls.popleft()
+                
+                if len(self.calls) < self.max_calls:
+                    self.calls.append(now)
+                    return
+                
+                wait = self.period - (now - self.calls[0])
+            time.sleep(wait)
+
+def create_nvd_rate_limiter():
+    """NVD allows 50 requests / 30s with an API key, 5 / 30s without"""
+    
+    if os.getenv('NVD_API_KEY'):
+        return RateLimiter(50, 30)
+    return RateLimiter(5, 30)
@@ -0,0 +1,64 @@
+import os
+import uuid
+from qdrant_client import QdrantClient, models
+from embedding_config import STORE_SUFFIX
+
+QDRANT_COLLECTION = "cve_all_collection" + STORE_SUFFIX
+
+def get_qdrant_client():
+    """Return a Qdrant client if QDRANT_URL is configured, otherwise None"""
+    
+    qdrant_url = os.getenv('QDRANT_URL')
+    if not qdrant_url:
+        return None
+    
+    return QdrantClient(url=qdrant_url, api_key=os.getenv('QDRANT_API_KEY'))
+
+def ensure_collection(client, vector_size):
+    """Create the INT8-quantized CVE collection if it does not exist yet
+
+    Full-precision vectors stay on disk for rescoring; only the INT8
+    copies (~4x smaller) are kept in RAM for the search itself.
+    """
+    
+    if client.collection_exists(QDRANT_COLLECTION):
+        return
+    
+    print(f"Creating Qdrant collection '{QDRANT_COLLECTION}' (INT8 quantized)...")
+    client.create_collection(
+        collection_name=QDRANT_COLLECTION,
+        vectors_config=models.VectorParams(
+            size=vector_size,
+            distance=models.Distance.COSINE,
+            on_disk=True
+        ),
+        quantization_config=models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8,
+                always_ram=True
+            )
+        )
+    )
+
+def point_id(cve_id):
+    """Qdrant needs UUID point IDs, so derive a stable one from the CVE ID"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, cve_id))
+
+def upsert_cves(client, embeddings, documents, metadatas):
+    """Upsert precomputed CVE vectors into Qdrant (replaces older versions)"""
+    
+    if len(embeddings) == 0:
+        return
+    
+    ensure_collection(client, len(embeddings[0]))
+    
+    # Payload layout matches what langchain_qdrant.QdrantVectorStore reads
+    points = [
+        models.PointStruct(
+            id=point_id(metadata['cve_id']),
+            vector=[float(x) for x in vector],
+            payload={"page_content": document, "metadata": metadata}
+        )
+        for vector, document, metadata in zip(embeddings, documents, metadatas)
+    ]
+    client.upsert(collection_name=QDRANT_COLLECTION, points=points)
@@ -1,11 +1,11 @@
 import os
+import re
 from dotenv import load_dotenv
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
+from chroma_store import open_vectorstore
+from embedding_model import get_embeddings, QueryCachedEmbeddings
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
 
 # Disable tokenizer parallelism warning
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -17,19 +17,12 @@ def load_vectorstore():
     
     print("Loading vector store from disk...")
     
-    # Must use the SAME embedding model as training
-    embeddings = HuggingFaceEmbeddings(
-        model_name="sentence-transformers/all-mpnet-base-v2",
-        model_kwargs={'device': 'mps'},
-        encode_kwargs={'normalize_embeddings': True}
-    )
+    # Must use the SAME embedding model as training; query vectors are
+    # cached so repeated questions skip the model
+    embeddings = QueryCachedEmbeddings(get_embeddings())
     
     # Load existing ChromaDB
-    vectorstore = Chroma(
-        persist_directory="./chroma_db_all",
-        embedding_function=embeddings,
-        collection_name="cve_all_collection"
-    )
+    vectorstore = open_vectorstore(embeddings)
     
     # Get collection info
     collection = vectorstore._collection
@@ -40,6 +33,47 @@ def load_vectorstore():
     
     return vectorstore
 
+# "CVSS score above 9.5", "score >= 7", "cvss at least 9" ...
+SCORE_FILTER_PATTERN = re.compile(
+    r"(?:cvss|score)\D{0,20}?(>=|>|above|over|greater than|at least)\s*(\d+(?:\.\d+)?)",
+    re.IGNORECASE
+)
+
+def score_filter(query):
+    """Build a Chroma metadata filter for a CVSS score predicate in the query, if any"""
+    
+    match = SCORE_FILTER_PATTERN.search(query)
+    if not match:
+        return None
+    
+    operator = "$gte" if match.group(1).lower() in (">=", "at least") else "$gt"
+    return {"cvss_score": {operator: float(match.group(2))}}
+
+def retrieve(retriever, query):
+    """Retrieve documents, filtering by CVSS score in Chroma when the query asks for it"""
+    
+    score_condition = score_filter(query)
+    if score_condition is None:
+        return retriever.invoke(query)
+    
+    docs = retriever.vectorstore.similarity_search(
+        query, k=retriever.search_kwargs["k"], filter=score_condition
+    )
+    if docs:
+        return docs
+    
+    # Stores not yet converted by migrate_metadata.py hold scores as strings,
+    # which the numeric filter never matches
+    print("No CVEs matched the score filter; falling back to unfiltered search")
+    return retriever.invoke(query)
+
+# Per-document characters sent to the LLM; the description is the only
+# unbounded part of a CVE document
+CONTEXT_CHARS_PER_DOC = 400
+
+def format_docs(docs):
+    return "\n\n".join(doc.page_content[:CONTEXT_CHARS_PER_DOC] for doc in docs)
+
 def create_qa_chain(vectorstore):
     """Create a QA chain with LLM"""
     
@@ -49,8 +83,10 @@ def create_qa_chain(vectorstore):
         temperature=0.7
     )
     
+    # MMR over the 20 nearest CVEs: return 5 relevant but non-redundant ones
     retriever = vectorstore.as_retriever(
-        search_kwargs={"k": 5}  # Return top 5 most relevant CVEs
+        search_type="mmr",
+        search_kwargs={"k": 5, "fetch_k": 20, "lambda_mult": 0.5}
     )
     
     template = """You are a cybersecurity expert assistant specializing in vulnerability analysis. 
@@ -67,15 +103,9 @@ Answer:"""
     
     prompt = PromptTemplate.from_template(template)
     
-    def format_docs(docs):
-        return "\n\n".join(doc.page_content for doc in docs)
-    
-    qa_chain = (
-        {"context": retriever | format_docs, "question": RunnablePassthrough()}
-        | prompt
-        | llm
-        | StrOutputParser()
-    )
+    # Retrieval is done by the caller, so the same documents feed both the
+    # prompt and the source listing
+    qa_chain = prompt | llm | StrOutputParser()
     
     print("✓ QA Chain ready!\n")
     return qa_chain, retriever
@@ -87,11 +117,9 @@ def query_with_sources(qa_chain, retriever, query):
     print(f"QUERY: {query}")
     print("="*70)
     
-    # Get answer
-    answer = qa_chain.invoke(query)
-    
-    # Get source documents
-    source_docs = retriever.invoke(query)
+    # Retrieve once, then answer from the same documents
+    source_docs = retrieve(retriever, query)
+    answer = qa_chain.invoke({"context": format_docs(source_docs), "question": query})
     
     print("\nANSWER:")
     print("-"*70)
@@ -102,7 +130,7 @@ def query_with_sources(qa_chain, retriever, query):
     print("="*70)
     for i, doc in enumerate(source_docs, 1):
         print(f"\n[{i}] {doc.metadata['cve_id']}")
-        print(f"    Severity: {doc.metadata['cvss_severity']} (Score: {doc.metadata['cvss_score']})")
+        print(f"    Severity: {doc.metadata['cvss_severity']} (Score: {doc.metadata.get('cvss_score', 'N/A')})")
         print(f"    Status: {doc.metadata['vulnStatus']}")
         print(f"    Published: {doc.metadata['published'][:10]}")
     print("="*70)
@@ -1,79 +1,137 @@
 import os
-import requests
+import sys
+import asyncio
+import json
+import chromadb
+import orjson
 from dotenv import load_dotenv
 from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+from langchain_community.embeddings import FastEmbedEmbeddings
 from langchain_community.vectorstores import Chroma
-from langchain_core.prompts import PromptTemplate
+from langchain_classic.embeddings import CacheBackedEmbeddings
+from langchain_classic.storage import LocalFileStore
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnableParallel
+from functools import lru_cache
+from operator import itemgetter
+from nvd_client import create_nvd_session, NVD_API_URL
 
 load_dotenv('../.env')
 
+# Shared keep-alive session for NVD API calls
+nvd_session = create_nvd_session()
+
+# Documents are embedded locally with FastEmbed (ONNX Runtime on the CPU, no
+# API round-trips or cost); SINGLE_CVE_EMBEDDINGS=openai uses
+# text-embedding-3-small instead
+USE_OPENAI_EMBEDDINGS = os.getenv('SINGLE_CVE_EMBEDDINGS', 'fastembed') == 'openai'
+EMBEDDING_MODEL_NAME = "text-embedding-3-small" if USE_OPENAI_EMBEDDINGS else "BAAI/bge-small-en-v1.5"
+
+# One persistent Chroma client per process, reused by every store/query call.
+# Each embedding model gets its own collection (the vector sizes differ).
+CHROMA_DIR = "./chroma_db"
+CHROMA_COLLECTION = "cve_collection" if USE_OPENAI_EMBEDDINGS else "cve_collection_bge_small"
+chroma_client = chromadb.PersistentClient(path=CHROMA_DIR)
+
+# Nearest-neighbor IDs for the fixed demo queries, reused until the
+# collection size changes
+NEIGHBOR_CACHE_FILE = os.path.join(CHROMA_DIR, f"{CHROMA_COLLECTION}_demo_neighbors.json")
+
+# On-disk cache of document embeddings, keyed by content hash
+EMBEDDING_CACHE_DIR = "./emb_cache"
+
+# Last NVD response and its ETag, for conditional re-fetches
+NVD_CACHE_DIR = "./nvd_cache"
+SINGLE_CVE_BODY_FILE = os.path.join(NVD_CACHE_DIR, "single_cve.json")
+SINGLE_CVE_ETAG_FILE = os.path.join(NVD_CACHE_DIR, "single_cve.etag")
+
 #Fetching only one CVE from NVD API
 def fetch_single_cve():
-    url = "https://services.nvd.nist.gov/rest/json/cves/2.0"
     params = {
         "pubStartDate": "2025-01-01T00:00:00.000",
         "pubEndDate": "2025-01-31T23:59:59.999",
         "resultsPerPage": 1
     }
     
+    # Ask NVD to answer 304 Not Modified if the cached copy is still current
+    headers = {}
+    if os.path.exists(SINGLE_CVE_BODY_FILE) and os.path.exists(SINGLE_CVE_ETAG_FILE):
+        with open(SINGLE_CVE_ETAG_FILE, 'r') as f:
+            headers["If-None-Match"] = f.read().strip()
+    
     print("Fetching CVE from NVD API.")
-    response = requests.get(url, params=params)
-    
-    if response.status_code == 200:
-        data = response.json()
-        if data.get('vulnerabilities'):
-            cve = data['vulnerabilities'][0]['cve']
-            print(f"Fetched CVE: {cve['id']}")
-            return cve
-        else:
-            print("No CVE found in the response")
-            return None
+    response = nvd_session.get(NVD_API_URL, params=params, headers=headers, timeout=30)
+    
+    if response.status_code == 304:
+        print("Not modified since last fetch, using cached response")
+        with open(SINGLE_CVE_BODY_FILE, 'rb') as f:
+            body = f.read()
+    elif response.status_code == 200:
+        body = response.content
+        etag = response.headers.get('ETag')
+        if etag:
+            os.makedirs(NVD_CACHE_DIR, exist_ok=True)
+            with open(SINGLE_CVE_BODY_FILE, 'wb') as f:
+                f.write(body)
+            with open(SINGLE_CVE_ETAG_FILE, 'w') as f:
+                f.write(etag)
     else:
         print(f"Error: {response.status_code}")
         return None
+    
+    data = orjson.loads(body)
+    if data.get('vulnerabilities'):
+        cve = data['vulnerabilities'][0]['cve']
+        print(f"Fetched CVE: {cve['id']}")
+        return cve
+    else:
+        print("No CVE found in the response")
+        return None
 
 # Converting CVE to LangChain Document
 def cve_to_document(cve):
     """Convert one CVE JSON object to a LangChain Document"""
     
-    # Extract the English description
-    description = ""
-    for desc in cve.get('descriptions', []):
-        if desc['lang'] == 'en':
-            description = desc['value']
-            break
+    cve_id = cve['id']
+    vuln_status = cve.get('vulnStatus', 'Unknown')
     
-    # Extract CVSS score if available
+    # Extract the English description (first match only)
+    description = next(
+        (desc['value'] for desc in cve.get('descriptions', ()) if desc['lang'] == 'en'),
+        ""
+    )
+    
+    # Extract CVSS score if available, preferring v3.1 over v2
     cvss_score = "N/A"
     cvss_severity = "N/A"
     
     metrics = cve.get('metrics', {})
-    if 'cvssMetricV31' in metrics and len(metrics['cvssMetricV31']) > 0:
-        cvss_data = metrics['cvssMetricV31'][0]['cvssData']
+    metric_v31 = metrics.get('cvssMetricV31')
+    metric_v2 = metrics.get('cvssMetricV2')
+    if metric_v31:
+        cvss_data = metric_v31[0]['cvssData']
         cvss_score = cvss_data.get('baseScore', 'N/A')
         cvss_severity = cvss_data.get('baseSeverity', 'N/A')
-    elif 'cvssMetricV2' in metrics and len(metrics['cvssMetricV2']) > 0:
-        cvss_score = metrics['cvssMetricV2'][0]['cvssData'].get('baseScore', 'N/A')
-        cvss_severity = metrics['cvssMetricV2'][0].get('baseSeverity', 'N/A')
+    elif metric_v2:
+        # v2 keeps the severity next to cvssData, not inside it
+        cvss_score = metric_v2[0]['cvssData'].get('baseScore', 'N/A')
+        cvss_severity = metric_v2[0].get('baseSeverity', 'N/A')
     
     # Creating the document content
-    content = f"""CVE ID: {cve['id']}
-Status: {cve.get('vulnStatus', 'Unknown')}
-Severity: {cvss_severity} (Score: {cvss_score})
-
-Description:
-{description}
-"""
+    content = "".join((
+        "CVE ID: ", cve_id,
+        "\nStatus: ", vuln_status,
+        "\nSeverity: ", cvss_severity, " (Score: ", str(cvss_score),
+        ")\n\nDescription:\n", description, "\n"
+    ))
     
     # Create metadata (vulnerability attributes exvluding the embeddings above)
     metadata = {
-        "cve_id": cve['id'],
+        "cve_id": cve_id,
         "published": cve['published'],
         "lastModified": cve['lastModified'],
-        "vulnStatus": cve.get('vulnStatus', 'Unknown'),
+        "vulnStatus": vuln_status,
         "cvss_score": str(cvss_score),
         "cvss_severity": cvss_severity,
         "source": "NVD"
@@ -85,88 +143,214 @@ Description:
         metadata=metadata
     )
     
-    print(f"Created document for {cve['id']}")
+    print(f"Created document for {cve_id}")
     return doc
 
-#Embedding and store in ChromaDB
-def embed_and_store(document):
-    """Embedding the document and store in ChromaDB"""
+# Model clients are built once per process and shared by every call
+@lru_cache(maxsize=1)
+def get_embeddings():
+    """Return the cache-backed document embeddings"""
     
-    print("Initializing OpenAI embeddings...")
-    embeddings = OpenAIEmbeddings(
-        model="text-embedding-3-small"
-    )
+    print(f"Initializing embeddings ({EMBEDDING_MODEL_NAME})...")
+    if USE_OPENAI_EMBEDDINGS:
+        underlying_embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL_NAME)
+    else:
+        underlying_embeddings = FastEmbedEmbeddings(model_name=EMBEDDING_MODEL_NAME)
     
-    print("Creating ChromaDB vector store...")
-    vectorstore = Chroma.from_documents(
-        documents=[document],
-        embedding=embeddings,
-        persist_directory="./chroma_db",
-        collection_name="cve_collection"
+    # Unchanged CVE text is served from the disk cache instead of being re-embedded
+    embeddings = CacheBackedEmbeddings.from_bytes_store(
+        underlying_embeddings,
+        LocalFileStore(EMBEDDING_CACHE_DIR),
+        namespace=EMBEDDING_MODEL_NAME,
+        key_encoder="sha256"
     )
-    
-    print("Document embedded and stored in ChromaDB!")
-    return vectorstore
+    return embeddings
 
-#Creating QA Chain with LLM
-def create_qa_chain(vectorstore):
-    """Create a QA chain with LLM for natural language responses"""
+@lru_cache(maxsize=1)
+def get_llm():
+    """Return the chat model used for answers"""
     
     print("Initializing ChatGPT for natural language responses...")
-    llm = ChatOpenAI(
+    return ChatOpenAI(
         model="gpt-3.5-turbo",
         temperature=0.7
     )
+
+#Embedding and store in ChromaDB
+def embed_and_store_many(documents, batch_size=1000):
+    """Embed documents in batches and store them in ChromaDB"""
+    
+    embeddings = get_embeddings()
+    
+    print("Opening ChromaDB vector store...")
+    vectorstore = Chroma(
+        client=chroma_client,
+        embedding_function=embeddings,
+        collection_name=CHROMA_COLLECTION,
+        # Cosine distance (set when the collection is created); Chroma stores
+        # vectors as float32 whatever is passed in, see qdrant_store.py for
+        # an int8-quantized index
+        collection_metadata={"hnsw:space": "cosine"}
+    )
+    
+    # Skip CVEs already stored at the same lastModified; a warm re-run goes
+    # straight to querying without touching the embeddings API
+    stored = vectorstore._collection.get(
+        ids=[doc.metadata['cve_id'] for doc in documents],
+        include=["metadatas"]
+    )
+    stored_versions = {
+        cve_id: metadata.get('lastModified')
+        for cve_id, metadata in zip(stored["ids"], stored["metadatas"])
+    }
+    documents = [
+        doc for doc in documents
+        if stored_versions.get(doc.metadata['cve_id']) != doc.metadata['lastModified']
+    ]
+    if not documents:
+        print("All documents already up to date in ChromaDB, skipping embedding")
+        return vectorstore
+    
+    # One Chroma write (one SQLite commit) per 1000 documents, not per
+    # document; the embeddings split each batch into model/API-sized chunks.
+    # upsert keyed by CVE ID makes re-runs replace entries instead of duplicating them.
+    for i in range(0, len(documents), batch_size):
+        batch = documents[i:i + batch_size]
+        texts = [doc.page_content for doc in batch]
+        vectorstore._collection.upsert(
+            ids=[doc.metadata['cve_id'] for doc in batch],
+            embeddings=embeddings.embed_documents(texts),
+            documents=texts,
+            metadatas=[doc.metadata for doc in batch]
+        )
+    
+    print(f"{len(documents)} document(s) embedded and stored in ChromaDB!")
+    return vectorstore
+
+def load_neighbor_cache(count, k):
+    """Load cached query -> CVE IDs, if it was built for this collection size and k"""
+    
+    if os.path.exists(NEIGHBOR_CACHE_FILE):
+        with open(NEIGHBOR_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+        if cache.get("count") == count and cache.get("k") == k:
+            return cache["neighbors"]
+    return {}
+
+def save_neighbor_cache(count, k, neighbors):
+    with open(NEIGHBOR_CACHE_FILE, 'w') as f:
+        json.dump({"count": count, "k": k, "neighbors": neighbors}, f)
+
+# Retrieving documents for several queries at once
+def retrieve_many(vectorstore, queries, k=1):
+    """Retrieve the top-k documents for each query
+
+    Neighbors of queries seen before come from the neighbor cache; the rest
+    are embedded in one call and searched with one batched ChromaDB query.
+    """
+    
+    collection = vectorstore._collection
+    count = collection.count()
+    neighbors = load_neighbor_cache(count, k)
     
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 3})
+    missing = [query for query in queries if query not in neighbors]
+    if missing:
+        results = collection.query(
+            query_embeddings=vectorstore.embeddings.embed_documents(missing),
+            n_results=k,
+            include=[]
+        )
+        neighbors.update(zip(missing, results["ids"]))
+        save_neighbor_cache(count, k, neighbors)
     
-    template = """Answer the question based on the following context about vulnerabilities:
+    # Fetch every needed document once, by ID
+    needed_ids = list({cve_id for query in queries for cve_id in neighbors[query]})
+    stored = collection.get(ids=needed_ids, include=["documents", "metadatas"])
+    docs_by_id = {
+        cve_id: Document(page_content=text, metadata=metadata)
+        for cve_id, text, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"])
+    }
+    
+    return [
+        [docs_by_id[cve_id] for cve_id in neighbors[query] if cve_id in docs_by_id]
+        for query in queries
+    ]
+
+# Formatting retrieved documents as prompt context
+@lru_cache(maxsize=128)
+def join_doc_texts(texts):
+    return "\n\n".join(texts)
 
-Context: {context}
+def format_docs(docs):
+    # Queries that retrieve the same documents reuse the joined context
+    return join_doc_texts(tuple(doc.page_content for doc in docs))
 
-Question: {question}
+# Rendering the prompt directly (a plain string is sent to the chat model
+# as a single user message, exactly like the PromptTemplate output was)
+def render_prompt(inputs):
+    return f"""Answer the question based on the following context about vulnerabilities:
+
+Context: {format_docs(inputs["docs"])}
+
+Question: {inputs["question"]}
 
 Answer:"""
+
+#Creating QA Chain with LLM
+def create_qa_chain():
+    """Create a QA chain with LLM for natural language responses"""
     
-    prompt = PromptTemplate.from_template(template)
+    llm = get_llm()
     
     # Create simple chain
-    def format_docs(docs):
-        return "\n\n".join(doc.page_content for doc in docs)
-    
-    qa_chain = (
-        {"context": retriever | format_docs, "question": RunnablePassthrough()}
-        | prompt
-        | llm
-        | StrOutputParser()
-    )
+    answer_chain = RunnableLambda(render_prompt) | llm | StrOutputParser()
+    
+    # Takes {"question", "docs"} (see retrieve_many) and returns both the
+    # answer and the documents it used
+    qa_chain = RunnableParallel(answer=answer_chain, sources=itemgetter("docs"))
     
     print("✓ QA Chain created!")
-    return qa_chain, retriever
+    return qa_chain
 
 # Updating the test_query function to use the QA chain
-def test_query_with_llm(qa_chain, retriever, query):
-    """Test querying with natural language response"""
+def test_queries_with_llm(qa_chain, vectorstore, queries):
+    """Test several queries at once with natural language responses"""
     
-    print(f"\nTesting query: '{query}'")
+    docs_per_query = retrieve_many(vectorstore, queries)
     
-    # Get answer
-    answer = qa_chain.invoke(query)
+    # Send all LLM calls at once on the async OpenAI client; total time is
+    # the slowest call instead of the sum of all of them
+    async def answer_all():
+        return await asyncio.gather(*[
+            qa_chain.ainvoke({"question": query, "docs": docs})
+            for query, docs in zip(queries, docs_per_query)
+        ])
     
-    # Get source docs
-    source_docs = retriever.invoke(query)
+    results = asyncio.run(answer_all())
     
-    print("\n" + "="*60)
-    print("NATURAL LANGUAGE RESPONSE:")
-    print("="*60)
-    print(answer)
-    print("\n" + "="*60)
-    print("SOURCE DOCUMENTS:")
-    print("="*60)
+    for query, result in zip(queries, results):
+        print_query_result(query, result["answer"], result["sources"])
+
+def print_query_result(query, answer, source_docs):
+    """Print the answer and source documents for one query"""
+    
+    # Built as one string and written once instead of a print per line
+    lines = [
+        f"\nTesting query: '{query}'",
+        "\n" + "="*60,
+        "NATURAL LANGUAGE RESPONSE:",
+        "="*60,
+        answer,
+        "\n" + "="*60,
+        "SOURCE DOCUMENTS:",
+        "="*60
+    ]
     for i, doc in enumerate(source_docs, 1):
-        print(f"\n[Source {i}] CVE ID: {doc.metadata['cve_id']}")
-        print(f"Severity: {doc.metadata['cvss_severity']} (Score: {doc.metadata['cvss_score']})")
-    print("="*60)
+        lines.append(f"\n[Source {i}] CVE ID: {doc.metadata['cve_id']}")
+        lines.append(f"Severity: {doc.metadata['cvss_severity']} (Score: {doc.metadata['cvss_score']})")
+    lines.append("="*60)
+    
+    sys.stdout.write("\n".join(lines) + "\n")
 
 if __name__ == "__main__":
     print("="*60)
@@ -177,16 +361,18 @@ if __name__ == "__main__":
     
     if cve:
         document = cve_to_document(cve)
-        vectorstore = embed_and_store(document)
-        qa_chain, retriever = create_qa_chain(vectorstore)
+        vectorstore = embed_and_store_many([document])
+        qa_chain = create_qa_chain()
 
         print("\n" + "="*60)
         print("TESTING NATURAL LANGUAGE RESPONSES")
         print("="*60)
         
-        test_query_with_llm(qa_chain, retriever, "What vulnerabilities were published in 2025?")
-        test_query_with_llm(qa_chain, retriever, "Tell me about CVE-2024-21675")
-        test_query_with_llm(qa_chain, retriever, "Is this vulnerability critical?")
+        test_queries_with_llm(qa_chain, vectorstore, [
+            "What vulnerabilities were published in 2025?",
+            "Tell me about CVE-2024-21675",
+            "Is this vulnerability critical?"
+        ])
         
         print("\nTest completed successfully!")
     else:
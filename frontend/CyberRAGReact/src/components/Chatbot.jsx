@@ -100,19 +100,64 @@ ${data.description}
           })
         });
   
-        const data = await response.json();
-  
-        if (data.success) {
-          const assistantMessage = {
-            role: 'assistant',
-            content: data.answer,
-            sources: data.sources,
-            timestamp: new Date()
-          };
-          setMessages(prev => [...prev, assistantMessage]);
-        } else {
+        if (!response.ok) {
+          const data = await response.json();
           throw new Error(data.error || 'Failed to get response');
         }
+
+        // The answer is streamed as Server-Sent Events: sources first, then answer tokens
+        const assistantMessage = {
+          role: 'assistant',
+          content: '',
+          sources: [],
+          timestamp: new Date()
+        };
+        let started = false;
+        // Adds the message on the first update, then replaces it in place
+        const showAssistantMessage = () => {
+          const snapshot = { ...assistantMessage };
+          if (started) {
+            setMessages(prev => [...prev.slice(0, -1), snapshot]);
+          } else {
+            started = true;
+            setMessages(prev => [...prev, snapshot]);
+          }
+        };
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+
+          buffer += decoder.decode(value, { stream: true });
+          const events = buffer.split('\n\n');
+          buffer = events.pop();
+
+          for (const event of events) {
+            if (!event.startsWith('data: ')) continue;
+            const payload = JSON.parse(event.slice(6));
+
+            if (payload.type === 'sources') {
+              assistantMessage.sources = payload.sources;
+              if (started) {
+                const snapshot = { ...assistantMessage };
+                setMessages(prev => [...prev.slice(0, -1), snapshot]);
+              }
+            } else if (payload.type === 'delta') {
+              assistantMessage.content += payload.delta;
+              showAssistantMessage();
+            } else if (payload.type === 'done') {
+              // An empty answer sends no delta; still show the reply and its sources
+              if (!started) showAssistantMessage();
+            } else if (payload.type === 'error') {
+              throw new Error(payload.error);
+            }
+          }
+        }
+
+        if (!started) showAssistantMessage();
       }
     } catch (error) {
       const errorMessage = {
@@ -225,7 +270,7 @@ ${data.description}
           </div>
         ))}
         
-        {loading && (
+        {loading && messages[messages.length - 1].role === 'user' && (
           <div style={{ display: 'flex', justifyContent: 'flex-start' }}>
             <div style={{
               padding: '1rem',